@@ -14,7 +14,10 @@
 # limitations under the License.
 """Encoders."""
 
+import math
+
 import gin
+import numpy as np
 
 import tensorflow as tf
 from tensorflow.keras import layers as tfkl
@@ -22,7 +25,6 @@ import tensorflow.keras.regularizers as regularizers   # pylint: disable=g-expli
 import tensorflow_probability as tfp
 
 from tf_agents.networks import network
-from tf_agents.networks import utils
 from tf_agents.utils import nest_utils
 
 
@@ -43,15 +45,41 @@ class FRNConv(network.Network):
                output_tanh_activation=False,
                batch_squash=True,
                dtype=tf.float32,
-               name='FRNConv'):
-    """Creates an instance of `FRNConv`."""
+               name='FRNConv',
+               jit_compile=True,
+               data_format='channels_last'):
+    """Creates an instance of `FRNConv`.
+
+    Args:
+      input_tensor_spec: A `tensor_spec.TensorSpec` of [H, W, C] images.
+      filters: A tuple. Number of filters of each conv layer.
+      strides: A tuple. Strides of each conv layer.
+      kernels: A tuple. Kernel sizes of each conv layer.
+      padding: A string. Padding of the conv layers.
+      output_dim: An integer. Output feature dimension.
+      output_tanh_activation: A boolean. Whether applying tanh to the output.
+      batch_squash: If True the outer_ranks of the observation are squashed into
+        the batch dimension.
+      dtype: The dtype to use by the layers, or 'mixed_bfloat16' for mixed
+        precision. The output features are always float32.
+      name: A string representing name of the network.
+      jit_compile: If True the forward pass is compiled with XLA.
+      data_format: A string, the layout of the conv stack, 'channels_last' or
+        'channels_first'. Inputs are [..., H, W, C] either way. Without XLA,
+        'channels_first' is only supported on GPU.
+    """
     super(FRNConv, self).__init__(
         input_tensor_spec=input_tensor_spec, state_spec=(), name=name)
     self.output_tanh_activation = output_tanh_activation
     self._batch_squash = batch_squash
+    self._channels_first = data_format == 'channels_first'
     self._encoder = tf.keras.Sequential()
     self._uint8_input = input_tensor_spec.dtype == tf.uint8
+    dtype = _dtype_policy(dtype)
 
+    # With jit_compile the whole stack compiles as a single XLA cluster. Each
+    # conv stays a library call whose output is written to memory; what fuses
+    # is the FRN chain after each second-moment reduction.
     for i in range(len(filters)):
       self._encoder.add(tfkl.Conv2D(
           filters=filters[i],
@@ -59,30 +87,80 @@ class FRNConv(network.Network):
           strides=strides[i],
           padding=padding,
           activation=None,
+          data_format=data_format,
           dtype=dtype,
           name='%s/conv%d' % (name, i)))
-      self._encoder.add(FRN())  # built-in TLU activation
-    self._encoder.add(tfkl.Flatten())
+      # built-in TLU activation
+      self._encoder.add(FRN(data_format=data_format, dtype=dtype))
+    # Flatten in channels_last order so that the weights of the dense layer do
+    # not depend on data_format.
+    self._encoder.add(tfkl.Flatten(data_format=data_format, dtype=dtype))
     self._encoder.add(tfkl.Dense(output_dim, dtype=dtype, name='%s/fc' % name))
-    self._encoder.add(tfkl.LayerNormalization(epsilon=1e-5))
+    self._encoder.add(tfkl.LayerNormalization(epsilon=1e-5, dtype=dtype))
     if self.output_tanh_activation:
-      self._encoder.add(tfkl.Activation(tf.keras.activations.tanh))
+      self._encoder.add(
+          tfkl.Activation(tf.keras.activations.tanh, dtype=dtype))
+    # Build eagerly so that no variables are created inside the compiled
+    # forward pass.
+    height, width, channels = input_tensor_spec.shape.as_list()
+    if self._channels_first:
+      self._encoder.build([None, channels, height, width])
+    else:
+      self._encoder.build([None, height, width, channels])
+    # Traced once for the batch-squashed [N, H, W, C] images. No layer behaves
+    # differently in training, so both modes share this function; split it per
+    # `training` value if such a layer is added.
+    self._forward = tf.function(
+        self._encode,
+        input_signature=[tf.TensorSpec([None, height, width, channels],
+                                       input_tensor_spec.dtype)],
+        experimental_compile=jit_compile, autograph=False)
+    self._jit_compile = jit_compile
+    self._infer = None
+    self._infer_batch_size = None
 
-  def call(self, inputs, step_type=None, network_state=(), training=False):
-    del step_type  # unused.
+  def build_inference(self, batch_size):
+    """Specializes the forward pass on a fixed batch size.
 
-    if self._uint8_input:
-      inputs = tf.cast(inputs, tf.float32) / 255.00
+    Batches of exactly `batch_size` images (after batch squashing) are then
+    encoded by a function traced and compiled once for that static shape;
+    other batch sizes keep using the generic forward pass.
+
+    Args:
+      batch_size: An integer. The batch size to specialize on, e.g. the batch
+        size of the environment the policy acts in.
+    """
+    self._infer_batch_size = batch_size
+    self._infer = tf.function(
+        self._encode,
+        input_signature=[tf.TensorSpec(
+            [batch_size] + self.input_tensor_spec.shape.as_list(),
+            self.input_tensor_spec.dtype)],
+        experimental_compile=self._jit_compile, autograph=False)
+
+  def call(self, inputs, step_type=None, network_state=(), training=False):
+    del step_type, training  # unused.
     if self._batch_squash:
-      outer_rank = nest_utils.get_outer_rank(inputs, self.input_tensor_spec)
-      batch_squash = utils.BatchSquash(outer_rank)
-      inputs = tf.nest.map_structure(batch_squash.flatten, inputs)
-    states = inputs
-    states = self._encoder(states, training=training)
+      batch_squash = _StaticBatchSquash(inputs, self.input_tensor_spec)
+      inputs = batch_squash.flatten(inputs, self.input_tensor_spec)
+    if (self._infer is not None and
+        inputs.shape[0] == self._infer_batch_size):
+      forward = self._infer
+    else:
+      forward = self._forward
+    states = forward(inputs)
     if self._batch_squash:
-      states = tf.nest.map_structure(batch_squash.unflatten, states)
+      states = batch_squash.unflatten(states)
     return states, network_state
 
+  def _encode(self, images):
+    """Encodes [N, H, W, C] images, optionally compiled with XLA."""
+    if self._uint8_input:
+      images = tf.cast(images, tf.float32) * (1. / 255.)
+    if self._channels_first:
+      images = tf.transpose(images, [0, 3, 1, 2])
+    return tf.cast(self._encoder(images), tf.float32)
+
 
 @gin.configurable
 class MVNormalDiagParamHead(network.Network):
@@ -91,7 +169,7 @@ class MVNormalDiagParamHead(network.Network):
   def __init__(self, input_tensor_spec, fc_layers=(128, 128), output_dim=50,
                scale=1.0, kernel_initializer='glorot_uniform', output_bn=True,
                batch_squash=True, dtype=tf.float32,
-               name='MVNormalDiagParamHead'):
+               name='MVNormalDiagParamHead', jit_compile=True):
     """Creates an instance of `MVNormalDiagParamHead`.
 
     Args:
@@ -107,14 +185,21 @@ class MVNormalDiagParamHead(network.Network):
       batch_squash: If True the outer_ranks of the observation are squashed into
         the batch dimension. This allow encoding networks to be used with
         observations with shape [BxTx...].
-      dtype: The dtype to use by the convolution and fully connected layers.
+      dtype: The dtype to use by the fully connected and batch norm layers, or
+        'mixed_bfloat16' for mixed precision. loc and scale_diag are always
+        float32.
       name: A string representing name of the network.
+      jit_compile: If True the forward pass is compiled with XLA.
     """
     super(MVNormalDiagParamHead, self).__init__(
         input_tensor_spec=input_tensor_spec, state_spec=(), name=name)
     self.scale = scale
     self.output_dim = output_dim
+    self._nested = tf.nest.is_nested(input_tensor_spec)
+    # Makes softplus(0.) map to 0.693; softplus(0.) is log(2).
+    self._softplus_scale = 0.693 / math.log(2.)
     self._batch_squash = batch_squash
+    dtype = _dtype_policy(dtype)
 
     self._fc_encoder = tf.keras.Sequential()
     for fc_layer_units in fc_layers:
@@ -130,26 +215,74 @@ class MVNormalDiagParamHead(network.Network):
             kernel_initializer=tf.compat.v1.variance_scaling_initializer(1e-4),
             dtype=dtype))
     if output_bn:
-      self._fc_encoder.add(tfkl.BatchNormalization())
+      self._fc_encoder.add(tfkl.BatchNormalization(dtype=dtype))
+    # Build eagerly so that no variables are created inside the compiled
+    # forward pass.
+    self._input_dim = sum(spec.shape.as_list()[-1]
+                          for spec in tf.nest.flatten(input_tensor_spec))
+    self._fc_encoder.build([None, self._input_dim])
+    self._forward = tf.function(
+        self._params, experimental_compile=jit_compile, autograph=False)
 
   def call(self, inputs, step_type=None, network_state=(), training=False):
     del step_type  # unused.
+    return self._forward(inputs, training), network_state
+
+  def _params(self, inputs, training):
+    """Forward pass of `call`, optionally compiled with XLA."""
     if self._batch_squash:
-      outer_rank = nest_utils.get_outer_rank(inputs, self.input_tensor_spec)
-      batch_squash = utils.BatchSquash(outer_rank)
-      inputs = tf.nest.map_structure(batch_squash.flatten, inputs)
-    states = tf.concat(inputs, axis=-1)
-    states = self._fc_encoder(states, training=training)
+      batch_squash = _StaticBatchSquash(inputs, self.input_tensor_spec)
+      if self._nested:
+        inputs = tf.nest.map_structure(
+            batch_squash.flatten, inputs, self.input_tensor_spec)
+      else:
+        inputs = batch_squash.flatten(inputs, self.input_tensor_spec)
+    states = tf.concat(inputs, axis=-1) if self._nested else inputs
+    states = tf.cast(self._fc_encoder(states, training=training), tf.float32)
     if self._batch_squash:
-      states = tf.nest.map_structure(batch_squash.unflatten, states)
-    loc = states[..., :self.output_dim]
+      states = batch_squash.unflatten(states)
+    loc, raw_scale = tf.split(states, num_or_size_splits=2, axis=-1)
     if self.scale is None:
-      scale_diag = tf.nn.softplus(states[..., self.output_dim:])
-      scale_diag *= 0.693 / tf.nn.softplus(0.)
-      scale_diag += 1e-6
+      scale_diag = tf.nn.softplus(raw_scale) * self._softplus_scale + 1e-6
     else:
-      scale_diag = tf.ones_like(loc) * self.scale
-    return (loc, scale_diag), network_state
+      scale_diag = tf.fill(tf.shape(loc), tf.constant(self.scale, loc.dtype))
+    return loc, scale_diag
+
+  def export_inference(self):
+    """Returns the MLP with the output batch norm folded into the last layer.
+
+    The returned model computes the same function as the MLP of this head with
+    `training=False`: the batch norm is an affine transform given its moving
+    statistics, so it is absorbed into the kernel and bias of the last dense
+    layer. Weights are copied, so call this after training.
+
+    Returns:
+      A built `tf.keras.Sequential` mapping the concatenated, batch-squashed
+      inputs to the concatenated loc and pre-softplus scale.
+    """
+    fc_layers = list(self._fc_encoder.layers)
+    bn = None
+    if isinstance(fc_layers[-1], tfkl.BatchNormalization):
+      bn = fc_layers.pop()
+    inference_encoder = tf.keras.Sequential(
+        [tfkl.Dense.from_config(layer.get_config()) for layer in fc_layers])
+    inference_encoder.build([None, self._input_dim])
+    for layer, inference_layer in zip(fc_layers, inference_encoder.layers):
+      inference_layer.set_weights(layer.get_weights())
+
+    if bn is not None:
+      last_layer = inference_encoder.layers[-1]
+      kernel, bias = last_layer.get_weights()
+      moving_mean, moving_variance = tf.keras.backend.batch_get_value(
+          [bn.moving_mean, bn.moving_variance])
+      factor = 1. / np.sqrt(moving_variance + bn.epsilon)
+      if bn.scale:
+        factor *= tf.keras.backend.get_value(bn.gamma)
+      bias = (bias - moving_mean) * factor
+      if bn.center:
+        bias += tf.keras.backend.get_value(bn.beta)
+      last_layer.set_weights([kernel * factor, bias])
+    return inference_encoder
 
 
 class FRN(tf.keras.layers.Layer):
@@ -165,6 +298,7 @@ class FRN(tf.keras.layers.Layer):
                tau_regularizer=None,
                beta_regularizer=None,
                gamma_regularizer=None,
+               data_format='channels_last',
                **kwargs):
     """Initialize the FRN layer.
 
@@ -174,16 +308,29 @@ class FRN(tf.keras.layers.Layer):
       tau_regularizer: tf.keras.regularizer for tau.
       beta_regularizer: tf.keras.regularizer for beta.
       gamma_regularizer: tf.keras.regularizer for gamma.
+      data_format: A string, 'channels_last' for [N, H, W, C] inputs or
+        'channels_first' for [N, C, H, W] inputs.
       **kwargs: keyword arguments passed to the Keras layer base class.
     """
     self.reg_epsilon = reg_epsilon
-    self.tau_regularizer = regularizers.get(tau_regularizer)
-    self.beta_regularizer = regularizers.get(beta_regularizer)
-    self.gamma_regularizer = regularizers.get(gamma_regularizer)
+    self.data_format = data_format
+    self._spatial_axes = [2, 3] if data_format == 'channels_first' else [1, 2]
+    # FRNConv creates FRN layers without regularizers; skip the lookups.
+    self.tau_regularizer = (
+        None if tau_regularizer is None else regularizers.get(tau_regularizer))
+    self.beta_regularizer = (
+        None if beta_regularizer is None
+        else regularizers.get(beta_regularizer))
+    self.gamma_regularizer = (
+        None if gamma_regularizer is None
+        else regularizers.get(gamma_regularizer))
     super(FRN, self).__init__(**kwargs)
 
   def build(self, input_shape):
-    par_shape = (1, 1, 1, input_shape[-1])  # [1,1,1,C]
+    if self.data_format == 'channels_first':
+      par_shape = (1, input_shape[1], 1, 1)  # [1,C,1,1]
+    else:
+      par_shape = (1, 1, 1, input_shape[-1])  # [1,1,1,C]
     self.tau = self.add_weight('tau', shape=par_shape, initializer='zeros',
                                regularizer=self.tau_regularizer,
                                trainable=True)
@@ -193,20 +340,84 @@ class FRN(tf.keras.layers.Layer):
     self.gamma = self.add_weight('gamma', shape=par_shape, initializer='ones',
                                  regularizer=self.gamma_regularizer,
                                  trainable=True)
+    super(FRN, self).build(input_shape)
 
   def call(self, x):
-    nu2 = tf.reduce_mean(tf.math.square(x), axis=[1, 2], keepdims=True)
-    x = x * tf.math.rsqrt(nu2 + self.reg_epsilon)
-    y = self.gamma*x + self.beta
-    z = tf.maximum(y, self.tau)
-    return z
+    # Under a 16-bit compute dtype the second moment is accumulated in float32
+    # so that it neither overflows nor underflows.
+    x_acc = x
+    if x.dtype in (tf.float16, tf.bfloat16):
+      x_acc = tf.cast(x, tf.float32)
+    nu2 = tf.reduce_mean(x_acc * x_acc, axis=self._spatial_axes, keepdims=True)
+    inv_nu = tf.cast(tf.math.rsqrt(nu2 + self.reg_epsilon), x.dtype)
+    # A single elementwise expression after the reduction, so that XLA emits
+    # one fused kernel instead of materializing each intermediate.
+    return tf.maximum(inv_nu * self.gamma * x + self.beta, self.tau)
 
   def get_config(self):
     config = super(FRN, self).get_config()
     config.update({
         'reg_epsilon': self.reg_epsilon,
+        'data_format': self.data_format,
         'tau_regularizer': regularizers.serialize(self.tau_regularizer),
         'beta_regularizer': regularizers.serialize(self.beta_regularizer),
         'gamma_regularizer': regularizers.serialize(self.gamma_regularizer),
     })
     return config
+
+
+def _dtype_policy(dtype):
+  """Wraps a policy name in a `Policy`, which TF 2.3 layers require."""
+  if isinstance(dtype, str):
+    return tf.keras.mixed_precision.experimental.Policy(dtype)
+  return dtype
+
+
+class _StaticBatchSquash(object):
+  """`tf_agents.networks.utils.BatchSquash` specialized on static shapes.
+
+  The outer rank is resolved once from `input_tensor_spec` when tracing, the
+  inner shapes come from the specs when they are fully defined, and the outer
+  shape is a Python list whenever it is statically known. The reshapes are
+  thus fully specialized at trace time and skipped altogether when there is a
+  single outer dimension.
+  """
+
+  def __init__(self, inputs, input_tensor_spec):
+    """Creates an instance of `_StaticBatchSquash`.
+
+    Args:
+      inputs: A nest of `Tensor`s matching `input_tensor_spec` with extra outer
+        dimensions.
+      input_tensor_spec: A nest of `tensor_spec.TensorSpec` representing the
+        inputs without their outer dimensions.
+    """
+    self._outer_rank = nest_utils.get_outer_rank(inputs, input_tensor_spec)
+    tensor = tf.nest.flatten(inputs)[0]
+    outer_shape = tensor.shape[:self._outer_rank]
+    if self._outer_rank == 1:
+      self._outer_shape = None  # unused
+    elif outer_shape.is_fully_defined():
+      self._outer_shape = outer_shape.as_list()
+    else:
+      self._outer_shape = tf.shape(tensor)[:self._outer_rank]
+
+  def flatten(self, tensor, spec):
+    """Merges the outer dimensions of `tensor` into one batch dimension."""
+    if self._outer_rank == 1:
+      return tensor
+    if spec.shape.is_fully_defined():
+      return tf.reshape(tensor, [-1] + spec.shape.as_list())
+    return tf.reshape(
+        tensor,
+        tf.concat([[-1], tf.shape(tensor)[self._outer_rank:]], axis=0))
+
+  def unflatten(self, tensor):
+    """Restores the outer dimensions of a [N, ...] `tensor`."""
+    if self._outer_rank == 1:
+      return tensor
+    inner_shape = tensor.shape[1:]
+    if isinstance(self._outer_shape, list) and inner_shape.is_fully_defined():
+      return tf.reshape(tensor, self._outer_shape + inner_shape.as_list())
+    return tf.reshape(
+        tensor, tf.concat([self._outer_shape, tf.shape(tensor)[1:]], axis=0))
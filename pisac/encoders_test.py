@@ -0,0 +1,305 @@
+# coding=utf-8
+# Copyright 2020 The PI-SAC Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for pisac.encoders."""
+
+import itertools
+
+from absl.testing import parameterized
+import numpy as np
+from pisac import encoders
+import tensorflow as tf  # pylint: disable=g-explicit-tensorflow-version-import
+
+from tf_agents.networks import utils
+from tf_agents.utils import nest_utils
+from tf_agents.utils import test_utils
+
+
+class MVNormalDiagParamHeadTest(parameterized.TestCase, test_utils.TestCase):
+
+  def _randomizeOutputBatchNorm(self, head):
+    """Sets non-trivial gamma, beta, moving mean and moving variance."""
+    # pylint: disable=protected-access
+    bn = head._fc_encoder.layers[-1]
+    bn.set_weights([np.random.uniform(0.5, 2., size=w.shape).astype(np.float32)
+                    for w in bn.get_weights()])
+
+  @parameterized.parameters(
+      itertools.product([False, True], [None, 1.0], [[5], [5, 2]]))
+  def testCall(self, nested, scale, outer_dims):
+    # pylint: disable=protected-access
+    feature_spec = tf.TensorSpec([4], tf.float32)
+    spec = [feature_spec, tf.TensorSpec([3], tf.float32)
+           ] if nested else feature_spec
+    head = encoders.MVNormalDiagParamHead(
+        spec, fc_layers=(8,), output_dim=3, scale=scale)
+    # Non-trivial outputs despite the small initial kernel of the last layer.
+    self._randomizeOutputBatchNorm(head)
+    inputs = tf.nest.map_structure(
+        lambda s: tf.random.uniform(outer_dims + s.shape.as_list()), spec)
+
+    (loc, scale_diag), _ = head(inputs, training=False)
+
+    states = head._fc_encoder(
+        tf.concat([tf.reshape(t, [-1, t.shape[-1]])
+                   for t in tf.nest.flatten(inputs)], axis=-1),
+        training=False)
+    states = tf.reshape(states, outer_dims + [6])
+    expected_loc = states[..., :3]
+    if scale is None:
+      expected_scale_diag = (
+          tf.nn.softplus(states[..., 3:]) * 0.693 / np.log(2.) + 1e-6)
+    else:
+      expected_scale_diag = tf.ones_like(expected_loc) * scale
+
+    self.assertEqual(loc.shape.as_list(), outer_dims + [3])
+    self.assertEqual(scale_diag.shape.as_list(), outer_dims + [3])
+    loc_, scale_diag_, expected_loc_, expected_scale_diag_ = self.evaluate(
+        [loc, scale_diag, expected_loc, expected_scale_diag])
+    self.assertAllClose(loc_, expected_loc_, rtol=1e-5, atol=1e-5)
+    self.assertAllClose(scale_diag_, expected_scale_diag_, rtol=1e-5,
+                        atol=1e-5)
+
+  def testMixedPrecision(self):
+    spec = [tf.TensorSpec([4], tf.float32), tf.TensorSpec([3], tf.float32)]
+    head = encoders.MVNormalDiagParamHead(spec, output_dim=3, scale=None)
+    mixed_head = encoders.MVNormalDiagParamHead(
+        spec, output_dim=3, scale=None, dtype='mixed_bfloat16')
+    head.set_weights(
+        [np.random.uniform(0.5, 2., size=w.shape).astype(np.float32)
+         for w in head.get_weights()])
+    mixed_head.set_weights(head.get_weights())
+    inputs = [tf.random.uniform([5, 4]), tf.random.uniform([5, 3])]
+
+    expected, _ = head(inputs, training=True)
+    actual, _ = mixed_head(inputs, training=True)
+
+    self.assertEqual([t.dtype for t in actual], [tf.float32, tf.float32])
+    expected_, actual_ = self.evaluate([expected, actual])
+    self.assertAllClose(actual_, expected_, rtol=5e-2, atol=5e-2)
+
+  def testExportInference(self):
+    # pylint: disable=protected-access
+    head = encoders.MVNormalDiagParamHead(
+        tf.TensorSpec([4], tf.float32), fc_layers=(8,), output_dim=3,
+        scale=None)
+    self._randomizeOutputBatchNorm(head)
+
+    inputs = tf.random.uniform([5, 4])
+    expected = head._fc_encoder(inputs, training=False)
+    inference_encoder = head.export_inference()
+    actual = inference_encoder(inputs)
+
+    self.assertLen(inference_encoder.layers, 2)
+    expected_, actual_ = self.evaluate([expected, actual])
+    self.assertAllClose(expected_, actual_, rtol=1e-5, atol=1e-5)
+
+
+class StaticBatchSquashTest(test_utils.TestCase):
+
+  def _assertMatchesBatchSquash(self, inputs, input_signature=None,
+                                spec=tf.TensorSpec([3, 2], tf.float32)):
+
+    @tf.function(input_signature=input_signature)
+    def squash_and_unsquash(tensor):
+      # pylint: disable=protected-access
+      squashes = [encoders._StaticBatchSquash(tensor, spec),
+                  utils.BatchSquash(nest_utils.get_outer_rank(tensor, spec))]
+      flat = [squashes[0].flatten(tensor, spec), squashes[1].flatten(tensor)]
+      # Changes the inner shape before unflattening.
+      unflat = [squash.unflatten(tf.reduce_sum(t, axis=-1))
+                for squash, t in zip(squashes, flat)]
+      return flat, unflat
+
+    (flat, expected_flat), (unflat, expected_unflat) = self.evaluate(
+        squash_and_unsquash(tf.constant(inputs)))
+    self.assertAllEqual(flat, expected_flat)
+    self.assertAllEqual(unflat, expected_unflat)
+    self.assertAllEqual(unflat, np.sum(inputs, axis=-1))
+
+  def testBatched(self):
+    self._assertMatchesBatchSquash(
+        np.random.normal(size=[4, 3, 2]).astype(np.float32))
+
+  def testBatchedTimeMajorWithDynamicBatch(self):
+    self._assertMatchesBatchSquash(
+        np.random.normal(size=[4, 5, 3, 2]).astype(np.float32),
+        input_signature=[tf.TensorSpec([None, 5, 3, 2], tf.float32)])
+
+  def testBatchedTimeMajorWithStaticBatch(self):
+    self._assertMatchesBatchSquash(
+        np.random.normal(size=[4, 5, 3, 2]).astype(np.float32))
+
+  def testBatchedTimeMajorWithUnknownInnerDimension(self):
+    self._assertMatchesBatchSquash(
+        np.random.normal(size=[4, 5, 3, 2]).astype(np.float32),
+        input_signature=[tf.TensorSpec([None, 5, None, 2], tf.float32)],
+        spec=tf.TensorSpec([None, 2], tf.float32))
+
+  def testUnbatched(self):
+    self._assertMatchesBatchSquash(
+        np.random.normal(size=[3, 2]).astype(np.float32))
+
+
+class FRNTest(test_utils.TestCase):
+
+  def testCallAtDifferentSpatialSize(self):
+    layer = encoders.FRN()
+    layer(tf.random.normal([2, 6, 6, 3]))
+    x = np.random.normal(size=[2, 4, 5, 3]).astype(np.float32)
+
+    outputs = layer(tf.constant(x))
+
+    self.evaluate(tf.compat.v1.global_variables_initializer())
+    nu2 = np.mean(np.square(x), axis=(1, 2), keepdims=True)
+    expected = np.maximum(x / np.sqrt(nu2 + layer.reg_epsilon), 0.)
+    self.assertAllClose(self.evaluate(outputs), expected, rtol=1e-5, atol=1e-5)
+
+  def testChannelsFirstMatchesChannelsLast(self):
+    x = np.random.normal(size=[2, 4, 5, 3]).astype(np.float32)
+    params = [np.random.normal(size=[3]).astype(np.float32) for _ in range(3)]
+    channels_last = encoders.FRN()
+    channels_first = encoders.FRN(data_format='channels_first')
+    channels_last.build(x.shape)
+    channels_first.build(np.transpose(x, [0, 3, 1, 2]).shape)
+    channels_last.set_weights([p.reshape([1, 1, 1, 3]) for p in params])
+    channels_first.set_weights([p.reshape([1, 3, 1, 1]) for p in params])
+
+    expected = channels_last(tf.constant(x))
+    actual = channels_first(tf.constant(np.transpose(x, [0, 3, 1, 2])))
+
+    expected_, actual_ = self.evaluate([expected, actual])
+    tau, beta, gamma = params
+    nu2 = np.mean(np.square(x), axis=(1, 2), keepdims=True)
+    self.assertAllClose(
+        expected_,
+        np.maximum(gamma * x / np.sqrt(nu2 + channels_last.reg_epsilon) + beta,
+                   tau),
+        rtol=1e-5, atol=1e-5)
+    self.assertAllClose(np.transpose(actual_, [0, 2, 3, 1]), expected_,
+                        rtol=1e-5, atol=1e-5)
+
+  def testFloat16SecondMomentDoesNotOverflow(self):
+    # x * x exceeds the float16 range, so the second moment must be
+    # accumulated in float32.
+    x = np.random.uniform(300., 400., size=[2, 4, 4, 3]).astype(np.float32)
+    layer = encoders.FRN(
+        dtype=tf.keras.mixed_precision.experimental.Policy('mixed_float16'))
+
+    outputs = layer(tf.constant(x))
+
+    self.evaluate(tf.compat.v1.global_variables_initializer())
+    self.assertEqual(outputs.dtype, tf.float16)
+    nu2 = np.mean(np.square(x), axis=(1, 2), keepdims=True)
+    expected = np.maximum(x / np.sqrt(nu2 + layer.reg_epsilon), 0.)
+    self.assertAllClose(self.evaluate(outputs), expected, rtol=1e-2, atol=1e-2)
+
+  def testFloat64SecondMomentKeepsFloat64Precision(self):
+    x = np.random.normal(size=[2, 4, 4, 3])
+    layer = encoders.FRN(dtype=tf.float64)
+
+    outputs = layer(tf.constant(x))
+
+    self.evaluate(tf.compat.v1.global_variables_initializer())
+    self.assertEqual(outputs.dtype, tf.float64)
+    nu2 = np.mean(np.square(x), axis=(1, 2), keepdims=True)
+    expected = np.maximum(x / np.sqrt(nu2 + layer.reg_epsilon), 0.)
+    self.assertAllClose(self.evaluate(outputs), expected, rtol=1e-12,
+                        atol=1e-12)
+
+
+class FRNConvTest(test_utils.TestCase):
+
+  def testMixedPrecision(self):
+    spec = tf.TensorSpec([16, 16, 3], tf.uint8)
+    enc = encoders.FRNConv(spec, output_dim=4)
+    mixed_enc = encoders.FRNConv(spec, output_dim=4, dtype='mixed_bfloat16')
+    mixed_enc.set_weights(enc.get_weights())
+    images = tf.cast(
+        tf.random.uniform([2, 16, 16, 3], maxval=256, dtype=tf.int32),
+        tf.uint8)
+
+    expected, _ = enc(images, training=True)
+    actual, _ = mixed_enc(images, training=True)
+
+    self.assertEqual(actual.dtype, tf.float32)
+    expected_, actual_ = self.evaluate([expected, actual])
+    self.assertAllClose(actual_, expected_, rtol=5e-2, atol=5e-2)
+
+  def testUint8InputsAreScaledToUnitRange(self):
+    enc = encoders.FRNConv(tf.TensorSpec([16, 16, 3], tf.uint8), output_dim=4)
+    float_enc = encoders.FRNConv(
+        tf.TensorSpec([16, 16, 3], tf.float32), output_dim=4)
+    float_enc.set_weights(enc.get_weights())
+    images = tf.cast(
+        tf.random.uniform([2, 16, 16, 3], maxval=256, dtype=tf.int32),
+        tf.uint8)
+
+    expected, _ = float_enc(tf.cast(images, tf.float32) / 255.)
+    actual, _ = enc(images)
+
+    expected_, actual_ = self.evaluate([expected, actual])
+    self.assertAllClose(actual_, expected_, rtol=1e-5, atol=1e-5)
+
+  def testChannelsFirstMatchesChannelsLast(self):
+    # XLA supports channels_first convs on CPU as well.
+    spec = tf.TensorSpec([20, 20, 3], tf.float32)
+    channels_last = encoders.FRNConv(spec, output_dim=4, jit_compile=True)
+    channels_first = encoders.FRNConv(
+        spec, output_dim=4, jit_compile=True, data_format='channels_first')
+    # Per-channel FRN parameters, so that a wrong layout changes the outputs.
+    channels_last.set_weights(
+        [np.random.uniform(0.5, 2., size=w.shape).astype(np.float32)
+         for w in channels_last.get_weights()])
+    # Only the shapes of the FRN parameters depend on data_format; in
+    # particular the dense layer takes the same kernel thanks to Flatten.
+    channels_first.set_weights([
+        np.reshape(w, v.shape) for w, v in zip(channels_last.get_weights(),
+                                               channels_first.weights)])
+    inputs = tf.random.uniform([2, 20, 20, 3])
+
+    expected, _ = channels_last(inputs)
+    actual, _ = channels_first(inputs)
+
+    expected_, actual_ = self.evaluate([expected, actual])
+    self.assertAllClose(actual_, expected_, rtol=1e-4, atol=1e-4)
+
+  def testBuildInference(self):
+    # pylint: disable=protected-access
+    spec = tf.TensorSpec([16, 16, 3], tf.uint8)
+    enc = encoders.FRNConv(spec, output_dim=4)
+    enc.build_inference(batch_size=2)
+    images = tf.random.uniform([3, 16, 16, 3], maxval=256, dtype=tf.int32)
+    images = tf.cast(images, tf.uint8)
+
+    specialized, _ = enc(images[:2])
+    self.assertEqual(enc._infer.experimental_get_tracing_count(), 1)
+    self.assertEqual(enc._forward.experimental_get_tracing_count(), 0)
+
+    # Other batch sizes, and unknown ones, fall back to the generic path.
+    generic, _ = enc(images)
+    dynamic = tf.function(
+        lambda x: enc(x)[0],
+        input_signature=[tf.TensorSpec([None, 16, 16, 3], tf.uint8)])(images)
+    self.assertEqual(enc._infer.experimental_get_tracing_count(), 1)
+    self.assertEqual(enc._forward.experimental_get_tracing_count(), 1)
+
+    specialized_, generic_, dynamic_ = self.evaluate(
+        [specialized, generic, dynamic])
+    self.assertAllClose(specialized_, generic_[:2], rtol=1e-5, atol=1e-5)
+    self.assertAllClose(dynamic_, generic_, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -122,51 +122,48 @@ class SacAgentTest(test_utils.TestCase):
     self._obs_spec = tensor_spec.TensorSpec([2], tf.float32)
     self._time_step_spec = ts.time_step_spec(self._obs_spec)
     self._action_spec = tensor_spec.BoundedTensorSpec([1], tf.float32, -1, 1)
-
-  def testCreateAgent(self):
-    sac_agent.SacAgent(
+    self._critic_net = DummyCriticNet()
+
+    # Batch of two transitions shared by the loss tests.
+    self._observations = tf.constant([[1, 2], [3, 4]], dtype=tf.float32)
+    self._time_steps = ts.restart(self._observations, batch_size=2)
+    self._actions = tf.constant([[5], [6]], dtype=tf.float32)
+    self._rewards = tf.constant([10, 20], dtype=tf.float32)
+    self._discounts = tf.constant([0.9, 0.9], dtype=tf.float32)
+    self._next_observations = tf.constant([[5, 6], [7, 8]], dtype=tf.float32)
+    self._next_time_steps = ts.transition(
+        self._next_observations, self._rewards, self._discounts)
+
+  def _create_agent(self, **kwargs):
+    """Creates a `SacAgent` with a `DummyCriticNet` and `DummyActorPolicy`."""
+    return sac_agent.SacAgent(
         self._time_step_spec,
         self._action_spec,
-        critic_network=DummyCriticNet(),
+        critic_network=self._critic_net,
         actor_network=None,
         actor_optimizer=None,
         critic_optimizer=None,
         alpha_optimizer=None,
-        actor_policy_ctor=DummyActorPolicy)
+        actor_policy_ctor=DummyActorPolicy,
+        **kwargs)
 
-  def testCriticLoss(self):
-    agent = sac_agent.SacAgent(
-        self._time_step_spec,
-        self._action_spec,
-        critic_network=DummyCriticNet(),
-        actor_network=None,
-        actor_optimizer=None,
-        critic_optimizer=None,
-        alpha_optimizer=None,
-        actor_policy_ctor=DummyActorPolicy)
-
-    observations = tf.constant([[1, 2], [3, 4]], dtype=tf.float32)
-    time_steps = ts.restart(observations, batch_size=2)
-    actions = tf.constant([[5], [6]], dtype=tf.float32)
+  def testCreateAgent(self):
+    self._create_agent()
 
-    rewards = tf.constant([10, 20], dtype=tf.float32)
-    discounts = tf.constant([0.9, 0.9], dtype=tf.float32)
-    next_observations = tf.constant([[5, 6], [7, 8]], dtype=tf.float32)
-    next_time_steps = ts.transition(next_observations, rewards, discounts)
+  def testCriticLoss(self):
+    agent = self._create_agent()
 
     td_targets = [7.3, 19.1]
     pred_td_targets = [7., 10.]
 
-    self.evaluate(tf.compat.v1.global_variables_initializer())
-
     # Expected critic loss has factor of 2, for the two TD3 critics.
     expected_loss = self.evaluate(2 * tf.compat.v1.losses.mean_squared_error(
         tf.constant(td_targets), tf.constant(pred_td_targets)))
 
     loss = agent.critic_loss(
-        time_steps,
-        actions,
-        next_time_steps,
+        self._time_steps,
+        self._actions,
+        self._next_time_steps,
         td_errors_loss_fn=tf.math.squared_difference)
 
     self.evaluate(tf.compat.v1.global_variables_initializer())
@@ -174,39 +171,20 @@ class SacAgentTest(test_utils.TestCase):
     self.assertAllClose(loss_, expected_loss)
 
   def testCriticLossQAug(self):
-    agent = sac_agent.SacAgent(
-        self._time_step_spec,
-        self._action_spec,
-        critic_network=DummyCriticNet(),
-        actor_network=None,
-        actor_optimizer=None,
-        critic_optimizer=None,
-        alpha_optimizer=None,
-        actor_policy_ctor=DummyActorPolicy)
-
-    observations = tf.constant([[1, 2], [3, 4]], dtype=tf.float32)
-    time_steps = ts.restart(observations, batch_size=2)
-    actions = tf.constant([[5], [6]], dtype=tf.float32)
-
-    rewards = tf.constant([10, 20], dtype=tf.float32)
-    discounts = tf.constant([0.9, 0.9], dtype=tf.float32)
-    next_observations = tf.constant([[5, 6], [7, 8]], dtype=tf.float32)
-    next_time_steps = ts.transition(next_observations, rewards, discounts)
+    agent = self._create_agent()
 
     td_targets = [7.3, 19.1]
     pred_td_targets = [7., 10.]
 
-    self.evaluate(tf.compat.v1.global_variables_initializer())
-
     # Expected critic loss has factor of 2, for the two TD3 critics.
     expected_loss = self.evaluate(2 * tf.compat.v1.losses.mean_squared_error(
         tf.constant(td_targets), tf.constant(pred_td_targets)))
 
     loss = agent.critic_loss_q_aug(
-        time_steps,
-        actions,
-        next_time_steps,
-        target_obs=next_observations,
+        self._time_steps,
+        self._actions,
+        self._next_time_steps,
+        target_obs=self._next_observations,
         td_errors_loss_fn=tf.math.squared_difference)
 
     self.evaluate(tf.compat.v1.global_variables_initializer())
@@ -214,58 +192,26 @@ class SacAgentTest(test_utils.TestCase):
     self.assertAllClose(loss_, expected_loss)
 
   def testActorLoss(self):
-    agent = sac_agent.SacAgent(
-        self._time_step_spec,
-        self._action_spec,
-        critic_network=DummyCriticNet(),
-        actor_network=None,
-        actor_optimizer=None,
-        critic_optimizer=None,
-        alpha_optimizer=None,
-        actor_policy_ctor=DummyActorPolicy)
-
-    observations = tf.constant([[1, 2], [3, 4]], dtype=tf.float32)
-    time_steps = ts.restart(observations, batch_size=2)
+    agent = self._create_agent()
 
     expected_loss = (2 * 10 - (2 + 1) - (4 + 1)) / 2
-    loss = agent.actor_loss(time_steps)
+    loss = agent.actor_loss(self._time_steps)
 
     self.evaluate(tf.compat.v1.global_variables_initializer())
     loss_ = self.evaluate(loss)
     self.assertAllClose(loss_, expected_loss)
 
   def testAlphaLoss(self):
-    agent = sac_agent.SacAgent(
-        self._time_step_spec,
-        self._action_spec,
-        critic_network=DummyCriticNet(),
-        actor_network=None,
-        actor_optimizer=None,
-        critic_optimizer=None,
-        alpha_optimizer=None,
-        target_entropy=3.0,
-        initial_log_alpha=4.0,
-        actor_policy_ctor=DummyActorPolicy)
-    observations = tf.constant([[1, 2], [3, 4]], dtype=tf.float32)
-    time_steps = ts.restart(observations, batch_size=2)
-
+    agent = self._create_agent(target_entropy=3.0, initial_log_alpha=4.0)
     expected_loss = 4.0 * (-10 - 3)
-    loss = agent.alpha_loss(time_steps)
+    loss = agent.alpha_loss(self._time_steps)
 
     self.evaluate(tf.compat.v1.global_variables_initializer())
     loss_ = self.evaluate(loss)
     self.assertAllClose(loss_, expected_loss)
 
   def testPolicy(self):
-    agent = sac_agent.SacAgent(
-        self._time_step_spec,
-        self._action_spec,
-        critic_network=DummyCriticNet(),
-        actor_network=None,
-        actor_optimizer=None,
-        critic_optimizer=None,
-        alpha_optimizer=None,
-        actor_policy_ctor=DummyActorPolicy)
+    agent = self._create_agent()
 
     observations = tf.constant([[1, 2]], dtype=tf.float32)
     time_steps = ts.restart(observations)
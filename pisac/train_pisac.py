@@ -138,6 +138,7 @@ def train_eval(
     gradient_clipping=None,
     use_tf_functions=True,
     drivers_in_graph=True,
+    grappler_options=None,
     # Params for eval
     num_eval_episodes=10,
     eval_env_interval=5000,  # number of env steps
@@ -154,6 +155,11 @@ def train_eval(
     summarize_grads_and_vars=False,
     eval_metrics_callback=None):
   """train and eval for PI-SAC."""
+  if grappler_options is not None:
+    # Overrides Grappler's defaults, e.g. {'layout_optimizer': False} or
+    # {'auto_mixed_precision': True}; unspecified passes keep their defaults.
+    tf.config.optimizer.set_experimental_options(grappler_options)
+
   if random_seed is not None:
     tf.compat.v1.set_random_seed(random_seed)
     np.random.seed(random_seed)
@@ -419,6 +425,10 @@ def train_eval(
   if greedy_eval_policy:
     eval_policy = greedy_policy.GreedyPolicy(eval_policy)
 
+  # Acting only encodes batches of tf_env.batch_size observations.
+  if isinstance(e_enc, encoders.FRNConv):
+    e_enc.build_inference(tf_env.batch_size)
+
   def obs_to_feature(observation):
     feature, _ = e_enc(observation['pixels'], training=False)
     return tf.stop_gradient(feature)